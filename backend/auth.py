@@ -15,29 +15,72 @@ Usage:
         if user:
             return {"user_id": user["uid"]}
         return {"message": "Anonymous user"}
+
+    # Require a role or permissions from the user's custom claims (403 otherwise)
+    @app.post("/admin-only")
+    async def admin_route(user: AdminUser):
+        return {"user_id": user["uid"]}
+
+Browsers may authenticate with a session cookie instead of a Bearer token;
+see sessions.py for the endpoints that issue it.
+
+Multi-tenant deployments select the Firebase project per request with the
+X-Tenant-ID header, or by the token's `aud` claim when the header is absent.
 """
 
 import logging
+from collections.abc import Awaitable, Callable
 from typing import Annotated
 
-from fastapi import Depends, Header, HTTPException
+from fastapi import Cookie, Depends, Header, HTTPException
+from starlette.concurrency import run_in_threadpool
 
+from claims import get_permissions, get_roles
 from firebase_service import get_firebase_service
+from tenants import current_tenant, resolve_tenant
+from timing import phase
 
 logger = logging.getLogger(__name__)
 
+# Cookie holding the Firebase session cookie. "__session" is the only cookie
+# Firebase Hosting forwards to backends, so it works behind Hosting rewrites.
+SESSION_COOKIE_NAME = "__session"
+
+
+def parse_bearer_token(authorization: str) -> str:
+    """
+    Extract the token from a "Bearer <token>" Authorization header.
+
+    Raises:
+        HTTPException: 401 if the header is not in Bearer format
+    """
+    parts = authorization.split(" ")
+    if len(parts) != 2 or parts[0].lower() != "bearer":
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid authentication token format. Expected: Bearer <token>",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return parts[1]
+
 
 async def get_firebase_user(
     authorization: Annotated[str | None, Header()] = None,
+    x_tenant_id: Annotated[str | None, Header()] = None,
+    session_cookie: Annotated[str | None, Cookie(alias=SESSION_COOKIE_NAME)] = None,
 ) -> dict:
     """
     FastAPI dependency to verify Firebase authentication token.
 
     Extracts the Bearer token from the Authorization header and verifies it
-    using Firebase Admin SDK.
+    using Firebase Admin SDK against the request's tenant. Without an
+    Authorization header, a session cookie (see sessions.py) is accepted
+    instead.
 
     Args:
         authorization: The Authorization header value (e.g., "Bearer <token>")
+        x_tenant_id: Optional X-Tenant-ID header selecting the Firebase project
+        session_cookie: Optional Firebase session cookie
 
     Returns:
         Decoded Firebase token containing user info:
@@ -49,30 +92,36 @@ async def get_firebase_user(
         - firebase: Firebase-specific claims
 
     Raises:
-        HTTPException: 401 if token is missing, invalid, or expired
+        HTTPException: 400 if the tenant is unknown, 401 if token is missing,
+            invalid, or expired
     """
-    if not authorization:
-        raise HTTPException(
-            status_code=401,
-            detail="Missing authentication token",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
+    with phase("auth-parse"):
+        if authorization:
+            token = parse_bearer_token(authorization)
+            is_session = False
+        elif session_cookie:
+            token = session_cookie
+            is_session = True
+        else:
+            raise HTTPException(
+                status_code=401,
+                detail="Missing authentication token",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
 
-    # Parse Bearer token
-    parts = authorization.split(" ")
-    if len(parts) != 2 or parts[0].lower() != "bearer":
-        raise HTTPException(
-            status_code=401,
-            detail="Invalid authentication token format. Expected: Bearer <token>",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-
-    token = parts[1]
+        try:
+            current_tenant.set(resolve_tenant(x_tenant_id, token))
+        except LookupError as e:
+            raise HTTPException(status_code=400, detail=str(e)) from e
 
     try:
         firebase_service = get_firebase_service()
-        decoded_token = firebase_service.verify_token(token)
-        return decoded_token
+        if is_session:
+            # Checking revocation fetches the user record, so keep it off the loop
+            return await run_in_threadpool(
+                firebase_service.verify_session_cookie, token
+            )
+        return firebase_service.verify_token(token)
 
     except RuntimeError as e:
         # Firebase not initialized
@@ -93,6 +142,8 @@ async def get_firebase_user(
 
 async def get_optional_firebase_user(
     authorization: Annotated[str | None, Header()] = None,
+    x_tenant_id: Annotated[str | None, Header()] = None,
+    session_cookie: Annotated[str | None, Cookie(alias=SESSION_COOKIE_NAME)] = None,
 ) -> dict | None:
     """
     FastAPI dependency for optional Firebase authentication.
@@ -100,22 +151,126 @@ async def get_optional_firebase_user(
     Similar to get_firebase_user but returns None instead of raising
     an exception when no token is provided.
 
+    Browsers send the session cookie automatically, so a cookie that is no
+    longer valid (e.g. revoked by a logout on another device) is treated as
+    anonymous rather than failing the request.
+
     Args:
         authorization: The Authorization header value (optional)
+        x_tenant_id: Optional X-Tenant-ID header selecting the Firebase project
+        session_cookie: Optional Firebase session cookie
 
     Returns:
         Decoded Firebase token if valid token provided, None otherwise
 
     Raises:
-        HTTPException: 401 only if token is provided but invalid
+        HTTPException: 401 only if a Bearer token is provided but invalid
     """
-    if not authorization:
+    if authorization:
+        # If a Bearer token is provided, it must be valid
+        return await get_firebase_user(authorization, x_tenant_id)
+
+    if not session_cookie:
         return None
 
-    # If token is provided, it must be valid
-    return await get_firebase_user(authorization)
+    try:
+        return await get_firebase_user(None, x_tenant_id, session_cookie)
+    except HTTPException as e:
+        if e.status_code != 401:
+            raise
+        return None
 
 
 # Type alias for cleaner dependency injection
 FirebaseUser = Annotated[dict, Depends(get_firebase_user)]
 OptionalFirebaseUser = Annotated[dict | None, Depends(get_optional_firebase_user)]
+
+
+async def authorize(user: dict, check: Callable[[dict], bool], detail: str) -> None:
+    """
+    Authorize an authenticated user with `check` applied to their claims.
+
+    The check runs against the user's current custom claims from the user
+    record, read through the per-tenant claims cache, rather than the claims
+    in the token: a token keeps the claims it was issued with, so a removed
+    role would otherwise still be honoured until the token expired. Removals
+    take effect immediately on the instance that made them and within
+    FIREBASE_CLAIMS_CACHE_TTL elsewhere. Only routes that authorize pay for
+    the (cached) lookup. Use this for checks that depend on the request body;
+    for per-route requirements use require_roles / require_permissions.
+
+    Raises:
+        HTTPException: 403 if access is denied, 503 if the claims lookup fails
+    """
+    try:
+        firebase_service = get_firebase_service()
+        claims = await run_in_threadpool(
+            firebase_service.get_custom_claims, user["uid"]
+        )
+
+    except RuntimeError as e:
+        logger.error(f"Firebase service error: {e}")
+        raise HTTPException(
+            status_code=503,
+            detail="Authorization service unavailable",
+        ) from e
+
+    except ValueError as e:
+        # Lookup failed (e.g. Firebase outage); this is not a denial
+        logger.error(f"Custom claims lookup failed: {e}")
+        raise HTTPException(
+            status_code=503,
+            detail="Authorization service unavailable",
+        ) from e
+
+    if not check(claims):
+        raise HTTPException(status_code=403, detail=detail)
+
+
+def _authorizer(
+    check: Callable[[dict], bool],
+    detail: str,
+) -> Callable[..., Awaitable[dict]]:
+    """Build a dependency that authorizes the current user with `check`."""
+
+    async def dependency(user: FirebaseUser) -> dict:
+        await authorize(user, check, detail)
+        return user
+
+    return dependency
+
+
+def require_roles(*roles: str) -> Callable[..., Awaitable[dict]]:
+    """
+    Dependency factory requiring the user to hold at least one of `roles`.
+
+    Usage:
+        @app.post("/admin")
+        async def admin_route(user: dict = Depends(require_roles("admin"))):
+            ...
+
+    Raises:
+        HTTPException: 403 if the user has none of the roles
+    """
+    required = set(roles)
+    return _authorizer(
+        lambda claims: bool(get_roles(claims) & required),
+        detail="Insufficient role",
+    )
+
+
+def require_permissions(*permissions: str) -> Callable[..., Awaitable[dict]]:
+    """
+    Dependency factory requiring the user to hold all of `permissions`.
+
+    Raises:
+        HTTPException: 403 if any permission is missing
+    """
+    required = set(permissions)
+    return _authorizer(
+        lambda claims: required <= get_permissions(claims),
+        detail="Insufficient permissions",
+    )
+
+
+AdminUser = Annotated[dict, Depends(require_roles("admin"))]
@@ -0,0 +1,43 @@
+"""
+Roles and permissions carried in Firebase custom claims.
+
+Shared by the authorization dependencies in auth.py and by
+FirebaseService.set_custom_claims, which needs to tell whether a claims
+change takes privileges away.
+"""
+
+
+def _claim_values(claims: dict, key: str) -> set[str]:
+    """Read a list-of-strings claim, accepting a single string as well."""
+    value = claims.get(key)
+    if isinstance(value, str):
+        return {value}
+    if isinstance(value, list):
+        return {v for v in value if isinstance(v, str)}
+    return set()
+
+
+def get_roles(claims: dict) -> set[str]:
+    """
+    Roles granted by a set of custom claims.
+
+    Roles come from the `roles` claim (list) or `role` claim (string); the
+    common `admin: true` claim is treated as the "admin" role.
+    """
+    roles = _claim_values(claims, "roles") | _claim_values(claims, "role")
+    if claims.get("admin") is True:
+        roles.add("admin")
+    return roles
+
+
+def get_permissions(claims: dict) -> set[str]:
+    """Permissions granted by the `permissions` custom claim."""
+    return _claim_values(claims, "permissions")
+
+
+def privileges_removed(old_claims: dict, new_claims: dict) -> bool:
+    """Whether going from old_claims to new_claims drops any role or permission."""
+    return bool(
+        get_roles(old_claims) - get_roles(new_claims)
+        or get_permissions(old_claims) - get_permissions(new_claims)
+    )
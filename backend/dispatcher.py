@@ -0,0 +1,462 @@
+"""
+Priority-aware dispatcher for outgoing notifications.
+
+Sits in front of FirebaseService.send_multicast so that transactional
+notifications (password resets, security alerts) keep a bounded latency while
+bulk or marketing campaigns are being sent.
+
+Scheduling is two-level weighted fair queueing:
+- Priority classes share FCM throughput in proportion to their weight.
+- Within a class, callers share that class's throughput equally, so one busy
+  caller cannot starve the others.
+
+Each class can also have a rate budget (messages per second, token bucket).
+FCM quota is per Firebase project, so budgets apply per tenant: one tenant's
+campaign cannot use up another tenant's bulk budget. Per-class queue-wait
+latency is recorded for monitoring. One in-flight
+slot is reserved for transactional work, so a transactional send never waits
+for slow bulk multicasts to finish.
+
+Queues are bounded: once a class has NOTIFICATION_QUEUE_LIMIT_<CLASS> jobs
+waiting, further submissions fail with QueueFullError. Jobs whose submitter
+is cancelled while they wait (e.g. by a timeout) are dropped, not sent.
+
+Configuration (environment variables):
+    NOTIFICATION_DISPATCH_CONCURRENCY: Multicasts in flight at once (default 8)
+    NOTIFICATION_RATE_<CLASS>: Messages per second for a class and tenant,
+        e.g. NOTIFICATION_RATE_BULK=500 (unset or 0 means unlimited)
+    NOTIFICATION_QUEUE_LIMIT_<CLASS>: Jobs a class may have waiting
+        (default 1000)
+"""
+
+import asyncio
+import contextvars
+import logging
+import os
+import statistics
+import time
+from collections import deque
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from enum import Enum
+from functools import lru_cache, partial
+from typing import Any
+
+from tenants import current_tenant
+from timing import record_phase
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationPriority(str, Enum):
+    """Priority class of a notification."""
+
+    TRANSACTIONAL = "transactional"
+    NORMAL = "normal"
+    BULK = "bulk"
+
+
+# Relative share of FCM throughput per class when all classes are busy
+PRIORITY_WEIGHTS: dict[NotificationPriority, float] = {
+    NotificationPriority.TRANSACTIONAL: 16.0,
+    NotificationPriority.NORMAL: 4.0,
+    NotificationPriority.BULK: 1.0,
+}
+
+# Default rate budgets in messages per second per tenant (None means unlimited)
+DEFAULT_RATES: dict[NotificationPriority, float | None] = {
+    NotificationPriority.TRANSACTIONAL: None,
+    NotificationPriority.NORMAL: None,
+    NotificationPriority.BULK: 500.0,
+}
+
+# Default number of jobs each class may have waiting
+DEFAULT_QUEUE_LIMIT = 1000
+
+# In-flight slots only transactional work may use, so it never waits behind a
+# full set of slow bulk multicasts
+RESERVED_TRANSACTIONAL_SLOTS = 1
+
+# Number of recent queue-wait samples kept per class for latency stats
+WAIT_SAMPLES = 1000
+
+
+class QueueFullError(RuntimeError):
+    """Raised when a priority class already has its limit of jobs waiting."""
+
+
+class TokenBucket:
+    """Rate budget refilled continuously up to one second of burst."""
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.capacity = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, cost: float) -> float:
+        """Seconds until `cost` can be spent (0 if it can be spent now)."""
+        self._refill()
+        # A job larger than the bucket may run once the bucket is full
+        needed = min(cost, self.capacity)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def spend(self, cost: float) -> None:
+        """Spend `cost` tokens; large jobs leave the bucket in debt."""
+        self._refill()
+        self.tokens -= cost
+
+
+@dataclass
+class _Job:
+    tenant: str
+    caller: str
+    cost: float
+    call: Callable[[], Any]
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+    tag: float = 0.0
+    wait: float = 0.0
+    queued: bool = True
+
+
+class _ClassQueue:
+    """Per-class queue sharing the class's service fairly among callers."""
+
+    def __init__(self, weight: float, rate: float | None, limit: int) -> None:
+        self.weight = weight
+        self.rate = rate
+        self.limit = limit
+        self.finish = 0.0  # Virtual finish tag of the class's last service
+        self.waits: deque[float] = deque(maxlen=WAIT_SAMPLES)
+        self.dispatched = 0
+        self.cancelled = 0
+        self._queued = 0
+        self._callers: dict[str, deque[_Job]] = {}
+        self._caller_finish: dict[str, float] = {}
+        self._buckets: dict[str, TokenBucket] = {}
+        self._vtime = 0.0
+
+    def __len__(self) -> int:
+        """Jobs still waiting (cancelled jobs are not counted)."""
+        return self._queued
+
+    def push(self, job: _Job) -> None:
+        start = max(self._vtime, self._caller_finish.get(job.caller, 0.0))
+        job.tag = start + job.cost
+        self._caller_finish[job.caller] = job.tag
+        self._callers.setdefault(job.caller, deque()).append(job)
+        self._queued += 1
+        job.future.add_done_callback(partial(self._cancelled, job))
+
+    def _cancelled(self, job: _Job, _future: asyncio.Future) -> None:
+        # The future of a waiting job only completes if its submitter gave up
+        if job.queued:
+            job.queued = False
+            self._queued -= 1
+            self.cancelled += 1
+
+    def bucket(self, tenant: str) -> TokenBucket | None:
+        """The tenant's rate budget for this class (None if unlimited)."""
+        if not self.rate:
+            return None
+        bucket = self._buckets.get(tenant)
+        if bucket is None:
+            bucket = self._buckets[tenant] = TokenBucket(self.rate)
+        return bucket
+
+    def next_job(self) -> tuple[_Job | None, float]:
+        """
+        The waiting job to serve next, skipping tenants over their budget.
+
+        Returns:
+            The job (None if none is eligible) and, when waiting jobs are held
+            back only by rate budgets, the delay until one becomes eligible
+        """
+        # Cancelled jobs are dropped once they reach the front of their caller
+        for caller, jobs in list(self._callers.items()):
+            while jobs and jobs[0].future.done():
+                jobs.popleft()
+            if not jobs:
+                del self._callers[caller]
+
+        delay = float("inf")
+        heads = [jobs[0] for jobs in self._callers.values()]
+        heads.sort(key=lambda job: job.tag)
+        for job in heads:
+            bucket = self.bucket(job.tenant)
+            wait = bucket.delay(job.cost) if bucket else 0.0
+            if wait <= 0:
+                return job, 0.0
+            delay = min(delay, wait)
+        return None, delay
+
+    def pop(self, job: _Job) -> None:
+        """Remove a job returned by next_job."""
+        job.queued = False
+        self._queued -= 1
+        # Jobs of rate-limited tenants may be served out of tag order
+        self._vtime = max(self._vtime, job.tag - job.cost)
+
+        jobs = self._callers[job.caller]
+        jobs.popleft()
+        if not jobs:
+            del self._callers[job.caller]
+
+        # Tags of idle callers behind virtual time no longer affect scheduling
+        stale = [
+            caller
+            for caller, finish in self._caller_finish.items()
+            if caller not in self._callers and finish <= self._vtime
+        ]
+        for caller in stale:
+            del self._caller_finish[caller]
+
+
+class NotificationDispatcher:
+    """Weighted fair queueing dispatcher across priority classes and callers."""
+
+    def __init__(
+        self,
+        concurrency: int = 8,
+        rates: dict[NotificationPriority, float | None] | None = None,
+        queue_limits: dict[NotificationPriority, int] | None = None,
+    ) -> None:
+        rates = rates if rates is not None else DEFAULT_RATES
+        queue_limits = queue_limits or {}
+        self.concurrency = max(concurrency, RESERVED_TRANSACTIONAL_SLOTS + 1)
+        # Slots normal and bulk work may occupy; the rest stay free for
+        # transactional sends
+        self.shared_slots = self.concurrency - RESERVED_TRANSACTIONAL_SLOTS
+        self._classes = {
+            priority: _ClassQueue(
+                PRIORITY_WEIGHTS[priority],
+                rates.get(priority),
+                queue_limits.get(priority, DEFAULT_QUEUE_LIMIT),
+            )
+            for priority in NotificationPriority
+        }
+        self._vtime = 0.0
+        self._in_flight = 0
+        self._in_flight_shared = 0
+        self._tasks: set[asyncio.Task] = set()
+        self._wakeup: asyncio.Event | None = None
+        self._scheduler: asyncio.Task | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    async def submit(
+        self,
+        priority: NotificationPriority,
+        caller: str,
+        fn: Callable[..., Any],
+        *args: Any,
+        cost: float = 1.0,
+        **kwargs: Any,
+    ) -> Any:
+        """
+        Queue a blocking call and wait for its result.
+
+        The call runs in a worker thread with the submitter's context
+        (including the current tenant).
+
+        Args:
+            priority: Priority class of the work
+            caller: Identity used for fairness within the class
+            fn: Blocking function to run, e.g. FirebaseService.send_multicast
+            cost: Messages the call sends, charged against fairness and budget
+
+        Returns:
+            The return value of fn
+
+        Raises:
+            QueueFullError: If the class already has its limit of jobs waiting
+        """
+        queue = self._classes[priority]
+        if len(queue) >= queue.limit:
+            raise QueueFullError(f"{priority.value} notification queue is full")
+
+        self._ensure_started()
+
+        ctx = contextvars.copy_context()
+        call = partial(ctx.run, fn, *args, **kwargs)
+        job = _Job(
+            tenant=current_tenant.get(),
+            caller=caller,
+            cost=max(cost, 1.0),
+            call=call,
+            future=asyncio.get_running_loop().create_future(),
+        )
+
+        queue.push(job)
+        self._wakeup.set()
+        try:
+            return await job.future
+        finally:
+            record_phase("queue-wait", job.wait)
+
+    def _ensure_started(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._scheduler and not self._scheduler.done():
+            return
+
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._scheduler = loop.create_task(self._run())
+
+    def _select(self) -> tuple[NotificationPriority | None, _Job | None, float]:
+        """
+        Pick the class and job to serve next.
+
+        Returns:
+            The class and job (None if nothing is eligible) and, when queued
+            work is held back only by rate budgets, the delay until it becomes
+            eligible
+        """
+        best: NotificationPriority | None = None
+        best_job: _Job | None = None
+        best_finish = 0.0
+        delay = float("inf")
+
+        for priority, queue in self._classes.items():
+            if (
+                priority is not NotificationPriority.TRANSACTIONAL
+                and self._in_flight_shared >= self.shared_slots
+            ):
+                continue
+
+            job, wait = queue.next_job()
+            if job is None:
+                delay = min(delay, wait)
+                continue
+
+            finish = max(self._vtime, queue.finish) + job.cost / queue.weight
+            if best is None or finish < best_finish:
+                best, best_job, best_finish = priority, job, finish
+
+        return best, best_job, delay
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+
+            priority, job, delay = (None, None, float("inf"))
+            if self._in_flight < self.concurrency:
+                priority, job, delay = self._select()
+
+            if priority is None or job is None:
+                timeout = None if delay == float("inf") else delay
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except TimeoutError:
+                    pass
+                continue
+
+            queue = self._classes[priority]
+            queue.pop(job)
+            start = max(self._vtime, queue.finish)
+            queue.finish = start + job.cost / queue.weight
+            self._vtime = start
+            bucket = queue.bucket(job.tenant)
+            if bucket:
+                bucket.spend(job.cost)
+
+            wait = job.wait = time.monotonic() - job.enqueued_at
+            queue.waits.append(wait)
+            queue.dispatched += 1
+            # Bulk sends are expected to queue behind their rate budget
+            if wait > 1.0 and priority is not NotificationPriority.BULK:
+                logger.warning(
+                    f"{priority.value} notification waited {wait:.2f}s in queue"
+                )
+
+            self._in_flight += 1
+            shared = priority is not NotificationPriority.TRANSACTIONAL
+            if shared:
+                self._in_flight_shared += 1
+            task = loop.create_task(self._execute(job, shared))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, job: _Job, shared: bool) -> None:
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(None, job.call)
+            if not job.future.done():
+                job.future.set_result(result)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            self._in_flight -= 1
+            if shared:
+                self._in_flight_shared -= 1
+            self._wakeup.set()
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """
+        Queue depth, dispatch counts and recent queue-wait latency per class.
+
+        rate_limit is the budget each tenant gets for the class.
+        """
+        result = {}
+        for priority, queue in self._classes.items():
+            waits = sorted(queue.waits)
+            result[priority.value] = {
+                "weight": queue.weight,
+                "rate_limit": queue.rate,
+                "queued": len(queue),
+                "queue_limit": queue.limit,
+                "dispatched": queue.dispatched,
+                "cancelled": queue.cancelled,
+                "wait_ms": {
+                    "mean": _ms(statistics.fmean(waits)) if waits else 0.0,
+                    "p50": _ms(_percentile(waits, 0.50)),
+                    "p95": _ms(_percentile(waits, 0.95)),
+                    "max": _ms(waits[-1]) if waits else 0.0,
+                },
+            }
+        return result
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 2)
+
+
+def _rates_from_env() -> dict[NotificationPriority, float | None]:
+    rates = dict(DEFAULT_RATES)
+    for priority in NotificationPriority:
+        value = os.getenv(f"NOTIFICATION_RATE_{priority.name}")
+        if value is not None:
+            rates[priority] = float(value) or None
+    return rates
+
+
+def _queue_limits_from_env() -> dict[NotificationPriority, int]:
+    limits = {}
+    for priority in NotificationPriority:
+        value = os.getenv(f"NOTIFICATION_QUEUE_LIMIT_{priority.name}")
+        limits[priority] = int(value) if value else DEFAULT_QUEUE_LIMIT
+    return limits
+
+
+@lru_cache
+def get_dispatcher() -> NotificationDispatcher:
+    """Get the process-wide notification dispatcher."""
+    return NotificationDispatcher(
+        concurrency=int(os.getenv("NOTIFICATION_DISPATCH_CONCURRENCY", "8")),
+        rates=_rates_from_env(),
+        queue_limits=_queue_limits_from_env(),
+    )
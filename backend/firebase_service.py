@@ -4,18 +4,31 @@ Firebase Admin SDK service for token verification and push notifications.
 This service initializes Firebase Admin and provides methods to verify
 Firebase ID tokens sent from frontend/mobile clients, as well as send
 push notifications via Firebase Cloud Messaging (FCM).
+
+Every operation runs against the Firebase app of the current request's
+tenant (see tenants.py); single-project deployments only use the default app.
 """
 
 import logging
 import os
+import time
+from datetime import timedelta
 from functools import lru_cache
 from typing import Any
 
 import firebase_admin
-from firebase_admin import auth, credentials, firestore, messaging
+from firebase_admin import auth, credentials, firestore, firestore_async, messaging
+
+from claims import privileges_removed
+from dispatcher import NotificationPriority, get_dispatcher
+from tenants import TenantApp, current_tenant, get_app_registry
+from timing import phase
 
 logger = logging.getLogger(__name__)
 
+# Maximum age of the sign-in behind an ID token exchanged for a session cookie
+SESSION_MAX_AUTH_AGE_SECONDS = 5 * 60
+
 
 class FirebaseService:
     """Singleton service for Firebase Admin operations."""
@@ -37,6 +50,17 @@ class FirebaseService:
             logger.debug("Firebase already initialized")
             return
 
+        cls._initialize_default_app()
+
+        # Register the default app before tenant config is read, so a bad
+        # FIREBASE_TENANTS entry can never take the default tenant down too
+        registry = get_app_registry()
+        registry.register_default(cls._app)
+        registry.configure_from_env()
+
+    @classmethod
+    def _initialize_default_app(cls) -> None:
+        """Initialize the default Firebase app from the first available credentials."""
         try:
             # Option 1: Service account file path
             cred_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
@@ -69,11 +93,26 @@ class FirebaseService:
             logger.error(f"Failed to initialize Firebase: {e}")
             raise RuntimeError(f"Firebase initialization failed: {e}") from e
 
+    @classmethod
+    def tenant(cls) -> TenantApp:
+        """
+        Get the Firebase app and caches for the current request's tenant.
+
+        Raises:
+            RuntimeError: If the tenant's Firebase app is not available
+        """
+        return get_app_registry().get(current_tenant.get())
+
     @classmethod
     def verify_token(cls, id_token: str) -> dict:
         """
         Verify a Firebase ID token.
 
+        Verification is local (signature and expiry); revocation is not
+        checked, as that would cost a user-record lookup per token. Routes
+        that need current privileges authorize against the user record (see
+        auth.authorize).
+
         Args:
             id_token: The Firebase ID token from the client
 
@@ -84,19 +123,21 @@ class FirebaseService:
             RuntimeError: If Firebase is not initialized
             ValueError: If token is invalid or expired
         """
-        if not cls._initialized:
-            raise RuntimeError(
-                "Firebase is not initialized. Call FirebaseService.initialize() first."
-            )
+        tenant = cls.tenant()
+
+        cached = cls._cached_claims(tenant, id_token)
+        if cached is not None:
+            return cached
 
         try:
-            decoded_token = auth.verify_id_token(id_token)
+            with phase("verify-token"):
+                decoded_token = auth.verify_id_token(id_token, app=tenant.app)
             logger.info(f"Token verified for user: {decoded_token.get('uid')}")
-            return decoded_token
 
-        except auth.InvalidIdTokenError as e:
-            logger.warning(f"Invalid token: {e}")
-            raise ValueError("Invalid authentication token") from e
+            # Cache until the token expires so repeat requests skip verification
+            ttl = min(decoded_token.get("exp", 0) - time.time(), tenant.token_cache.ttl)
+            tenant.token_cache.set(id_token, dict(decoded_token), ttl=ttl)
+            return decoded_token
 
         except auth.ExpiredIdTokenError as e:
             logger.warning(f"Expired token: {e}")
@@ -106,6 +147,10 @@ class FirebaseService:
             logger.warning(f"Revoked token: {e}")
             raise ValueError("Authentication token has been revoked") from e
 
+        except auth.InvalidIdTokenError as e:
+            logger.warning(f"Invalid token: {e}")
+            raise ValueError("Invalid authentication token") from e
+
         except auth.CertificateFetchError as e:
             logger.error(f"Certificate fetch error: {e}")
             raise ValueError("Unable to verify token at this time") from e
@@ -115,41 +160,303 @@ class FirebaseService:
             raise ValueError("Token verification failed") from e
 
     @classmethod
-    def get_firestore_client(cls):
-        """Get the Firestore client."""
-        if not cls._initialized:
-            raise RuntimeError(
-                "Firebase is not initialized. Call FirebaseService.initialize() first."
+    def create_session_cookie(cls, id_token: str, expires_in: timedelta) -> str:
+        """
+        Exchange a Firebase ID token for a session cookie.
+
+        Only recently signed-in users may create a session, so a stolen
+        long-lived ID token cannot be turned into a long-lived cookie.
+
+        Args:
+            id_token: The Firebase ID token from the client
+            expires_in: Session lifetime (between 5 minutes and 14 days)
+
+        Returns:
+            The encoded session cookie
+
+        Raises:
+            RuntimeError: If Firebase is not initialized
+            ValueError: If the token is invalid or the sign-in is not recent
+        """
+        decoded_token = cls.verify_token(id_token)
+
+        auth_time = decoded_token.get("auth_time", 0)
+        if time.time() - auth_time > SESSION_MAX_AUTH_AGE_SECONDS:
+            raise ValueError("Recent sign-in required to create a session")
+
+        try:
+            return auth.create_session_cookie(
+                id_token, expires_in=expires_in, app=cls.tenant().app
             )
-        return firestore.client()
+        except Exception as e:
+            logger.error(f"Failed to create session cookie: {e}")
+            raise ValueError("Unable to create session") from e
+
+    @classmethod
+    def verify_session_cookie(cls, session_cookie: str) -> dict:
+        """
+        Verify a Firebase session cookie.
+
+        Uses the same per-tenant cache as verify_token, keyed separately so
+        cookies and ID tokens never collide. Verification also checks that the
+        user's sessions have not been revoked; the cache keeps that extra
+        lookup off the hot path.
+
+        Args:
+            session_cookie: The session cookie created by create_session_cookie
+
+        Returns:
+            Decoded claims containing user info (uid, email, etc.)
+
+        Raises:
+            RuntimeError: If Firebase is not initialized
+            ValueError: If the cookie is invalid, expired, or revoked
+        """
+        tenant = cls.tenant()
+        cache_key = ("session", session_cookie)
+
+        cached = cls._cached_claims(tenant, cache_key)
+        if cached is not None:
+            return cached
+
+        try:
+            with phase("verify-session"):
+                decoded_claims = auth.verify_session_cookie(
+                    session_cookie, check_revoked=True, app=tenant.app
+                )
+            logger.info(f"Session verified for user: {decoded_claims.get('uid')}")
+
+            ttl = min(
+                decoded_claims.get("exp", 0) - time.time(), tenant.token_cache.ttl
+            )
+            tenant.token_cache.set(cache_key, dict(decoded_claims), ttl=ttl)
+            return decoded_claims
+
+        except auth.ExpiredSessionCookieError as e:
+            logger.warning(f"Expired session cookie: {e}")
+            raise ValueError("Session has expired") from e
+
+        except auth.RevokedSessionCookieError as e:
+            logger.warning(f"Revoked session cookie: {e}")
+            raise ValueError("Session has been revoked") from e
+
+        except auth.InvalidSessionCookieError as e:
+            logger.warning(f"Invalid session cookie: {e}")
+            raise ValueError("Invalid session") from e
+
+        except auth.UserDisabledError as e:
+            logger.warning(f"Session for disabled user: {e}")
+            raise ValueError("User account has been disabled") from e
+
+        except auth.CertificateFetchError as e:
+            logger.error(f"Certificate fetch error: {e}")
+            raise ValueError("Unable to verify session at this time") from e
+
+        except Exception as e:
+            logger.error(f"Session verification failed: {e}")
+            raise ValueError("Session verification failed") from e
+
+    @classmethod
+    def revoke_session_cookie(cls, session_cookie: str) -> None:
+        """
+        End the session a cookie belongs to.
+
+        Revokes the user's refresh tokens, which invalidates all of their
+        session cookies (on every device), and drops cached verifications on
+        this instance. Other instances stop accepting the cookie once their
+        cached verification expires (FIREBASE_TOKEN_CACHE_TTL).
+
+        Args:
+            session_cookie: The session cookie to end
+
+        Raises:
+            RuntimeError: If Firebase is not initialized
+            ValueError: If the cookie is invalid or the revocation fails
+        """
+        tenant = cls.tenant()
+        tenant.token_cache.invalidate(("session", session_cookie))
+
+        try:
+            decoded_claims = auth.verify_session_cookie(session_cookie, app=tenant.app)
+        except Exception as e:
+            logger.warning(f"Not revoking invalid session cookie: {e}")
+            raise ValueError("Invalid session") from e
+
+        cls.revoke_user_sessions(decoded_claims["uid"])
+
+    @classmethod
+    def revoke_user_sessions(cls, uid: str) -> None:
+        """
+        Revoke a user's refresh tokens and session cookies.
+
+        Session cookies issued before now fail verification, the user can no
+        longer refresh their ID tokens, and verifications cached on this
+        instance from before now are discarded.
+
+        Args:
+            uid: The user's Firebase UID
+
+        Raises:
+            RuntimeError: If Firebase is not initialized
+            ValueError: If the revocation fails
+        """
+        tenant = cls.tenant()
+
+        try:
+            auth.revoke_refresh_tokens(uid, app=tenant.app)
+        except Exception as e:
+            logger.error(f"Failed to revoke sessions for user {uid}: {e}")
+            raise ValueError("Unable to revoke sessions") from e
+
+        tenant.revocations.set(uid, time.time())
+        logger.info(f"Revoked sessions for user {uid}")
+
+    @classmethod
+    def _cached_claims(cls, tenant: TenantApp, cache_key: Any) -> dict | None:
+        """
+        Get cached verified claims, unless the user was revoked since sign-in.
+        """
+        cached = tenant.token_cache.get(cache_key)
+        if cached is None:
+            return None
+
+        revoked_at = tenant.revocations.get(cached.get("uid"))
+        if revoked_at is not None and cached.get("auth_time", 0) < revoked_at:
+            tenant.token_cache.invalidate(cache_key)
+            return None
+        return dict(cached)
+
+    @classmethod
+    def get_custom_claims(cls, uid: str) -> dict:
+        """
+        Get a user's custom claims from their user record.
+
+        Results are cached per tenant, so repeated authorization checks for the
+        same user do not each trigger a remote lookup.
+
+        Args:
+            uid: The user's Firebase UID
+
+        Returns:
+            The user's custom claims (empty if none are set)
+
+        Raises:
+            RuntimeError: If Firebase is not initialized
+            ValueError: If the user record cannot be fetched
+        """
+        tenant = cls.tenant()
+
+        cached = tenant.claims_cache.get(uid)
+        if cached is not None:
+            return dict(cached)
+
+        try:
+            with phase("claims-lookup"):
+                user_record = auth.get_user(uid, app=tenant.app)
+            claims = dict(user_record.custom_claims or {})
+
+        except auth.UserNotFoundError:
+            logger.warning(f"User record not found for user: {uid}")
+            claims = {}
+
+        except Exception as e:
+            logger.error(f"Error fetching custom claims for user {uid}: {e}")
+            raise ValueError("Unable to fetch user claims") from e
+
+        tenant.claims_cache.set(uid, claims)
+        return dict(claims)
+
+    @classmethod
+    def set_custom_claims(cls, uid: str, claims: dict | None) -> None:
+        """
+        Replace a user's custom claims and drop any cached copy.
+
+        Existing ID tokens and session cookies keep the claims they were
+        issued with, but authorization checks read the updated record (see
+        auth.authorize). If a role or permission is taken away, the user's
+        sessions are also revoked first, so session cookies carrying it stop
+        being accepted; if that fails, the claims are left unchanged. Other
+        changes (e.g. granting a role) do not sign the user out.
+
+        Args:
+            uid: The user's Firebase UID
+            claims: New custom claims, or None to clear them
+
+        Raises:
+            RuntimeError: If Firebase is not initialized
+            ValueError: If the claims cannot be read or written, or sessions
+                cannot be revoked
+        """
+        tenant = cls.tenant()
+
+        try:
+            old_claims = auth.get_user(uid, app=tenant.app).custom_claims or {}
+        except Exception as e:
+            logger.error(f"Error fetching custom claims for user {uid}: {e}")
+            raise ValueError("Unable to fetch user claims") from e
+
+        if privileges_removed(old_claims, claims or {}):
+            cls.revoke_user_sessions(uid)
+
+        try:
+            auth.set_custom_user_claims(uid, claims, app=tenant.app)
+        except Exception as e:
+            logger.error(f"Error updating custom claims for user {uid}: {e}")
+            raise ValueError("Unable to update user claims") from e
+        finally:
+            tenant.claims_cache.invalidate(uid)
+
+        logger.info(f"Updated custom claims for user {uid}")
+
+    @classmethod
+    def invalidate_custom_claims(cls, uid: str) -> None:
+        """Drop a user's cached custom claims (e.g. after an external update)."""
+        cls.tenant().claims_cache.invalidate(uid)
+
+    @classmethod
+    def get_firestore_client(cls):
+        """Get the shared Firestore client for the current tenant."""
+        return cls.tenant().db
+
+    @classmethod
+    def get_async_firestore_client(cls) -> firestore_async.AsyncClient:
+        """Get the shared asyncio Firestore client for the current tenant."""
+        return cls.tenant().async_db
 
     @classmethod
     def get_user_device_tokens(cls, user_id: str) -> list[str]:
         """
         Get device tokens for a user from Firestore.
 
+        Clients add and remove their tokens directly in Firestore, so lists are
+        only cached when FIREBASE_DEVICE_CACHE_TTL is set; a cached list can
+        miss newly registered devices and still include removed ones for up to
+        that long. Empty lists are never cached.
+
         Args:
             user_id: The user's Firebase UID
 
         Returns:
             List of FCM device tokens
         """
-        if not cls._initialized:
-            raise RuntimeError(
-                "Firebase is not initialized. Call FirebaseService.initialize() first."
-            )
+        tenant = cls.tenant()
+
+        cached = tenant.device_cache.get(user_id)
+        if cached is not None:
+            return list(cached)
 
         try:
-            db = cls.get_firestore_client()
-            user_doc = db.collection("users").document(user_id).get()
+            with phase("firestore-read"):
+                user_doc = tenant.db.collection("users").document(user_id).get()
 
             if not user_doc.exists:
                 logger.warning(f"User document not found for user: {user_id}")
                 return []
 
-            data = user_doc.to_dict()
-            tokens = data.get("deviceTokens", [])
-            return tokens if isinstance(tokens, list) else []
+            tokens = _device_tokens(user_doc)
+            if tokens:
+                tenant.device_cache.set(user_id, tuple(tokens))
+            return tokens
 
         except Exception as e:
             logger.error(f"Error fetching device tokens for user {user_id}: {e}")
@@ -164,18 +471,110 @@ class FirebaseService:
             user_id: The user's Firebase UID
             token: The FCM token to remove
         """
-        if not cls._initialized:
-            raise RuntimeError(
-                "Firebase is not initialized. Call FirebaseService.initialize() first."
-            )
+        tenant = cls.tenant()
 
         try:
-            db = cls.get_firestore_client()
-            user_ref = db.collection("users").document(user_id)
-            user_ref.update({"deviceTokens": firestore.ArrayRemove([token])})
+            user_ref = tenant.db.collection("users").document(user_id)
+            with phase("token-cleanup"):
+                user_ref.update({"deviceTokens": firestore.ArrayRemove([token])})
             logger.info(f"Removed invalid token from user {user_id}")
         except Exception as e:
             logger.error(f"Error removing device token: {e}")
+        finally:
+            tenant.device_cache.invalidate(user_id)
+
+    @classmethod
+    async def get_user_device_tokens_async(cls, user_id: str) -> list[str]:
+        """
+        Get device tokens for a user from Firestore without blocking the loop.
+
+        Async counterpart of get_user_device_tokens, sharing its cache.
+
+        Args:
+            user_id: The user's Firebase UID
+
+        Returns:
+            List of FCM device tokens
+        """
+        tokens_by_user = await cls.get_device_tokens_for_users_async([user_id])
+        return tokens_by_user.get(user_id, [])
+
+    @classmethod
+    async def get_device_tokens_for_users_async(
+        cls, user_ids: list[str]
+    ) -> dict[str, list[str]]:
+        """
+        Get device tokens for several users in one concurrent batch read.
+
+        Users with cached tokens (see get_user_device_tokens) are served from
+        the cache; the rest are fetched together with a single get_all call.
+
+        Args:
+            user_ids: Firebase UIDs to look up
+
+        Returns:
+            Mapping of user ID to FCM device tokens (empty list if none)
+        """
+        tenant = cls.tenant()
+
+        result: dict[str, list[str]] = {}
+        missing: list[str] = []
+        for user_id in dict.fromkeys(user_ids):
+            cached = tenant.device_cache.get(user_id)
+            if cached is not None:
+                result[user_id] = list(cached)
+            else:
+                result[user_id] = []
+                missing.append(user_id)
+
+        if not missing:
+            return result
+
+        try:
+            users = tenant.async_db.collection("users")
+            refs = [users.document(user_id) for user_id in missing]
+
+            with phase("firestore-read"):
+                user_docs = [doc async for doc in tenant.async_db.get_all(refs)]
+
+            for user_doc in user_docs:
+                if not user_doc.exists:
+                    logger.warning(f"User document not found for user: {user_doc.id}")
+                    continue
+
+                tokens = _device_tokens(user_doc)
+                if tokens:
+                    tenant.device_cache.set(user_doc.id, tuple(tokens))
+                result[user_doc.id] = tokens
+
+        except Exception as e:
+            logger.error(f"Error fetching device tokens for users {missing}: {e}")
+
+        return result
+
+    @classmethod
+    async def remove_device_tokens_async(cls, user_id: str, tokens: list[str]) -> None:
+        """
+        Remove invalid device tokens from a user's document in a single write.
+
+        Args:
+            user_id: The user's Firebase UID
+            tokens: The FCM tokens to remove
+        """
+        if not tokens:
+            return
+
+        tenant = cls.tenant()
+
+        try:
+            user_ref = tenant.async_db.collection("users").document(user_id)
+            with phase("token-cleanup"):
+                await user_ref.update({"deviceTokens": firestore.ArrayRemove(tokens)})
+            logger.info(f"Removed {len(tokens)} invalid token(s) from user {user_id}")
+        except Exception as e:
+            logger.error(f"Error removing device tokens: {e}")
+        finally:
+            tenant.device_cache.invalidate(user_id)
 
     @classmethod
     def send_to_device(
@@ -197,10 +596,7 @@ class FirebaseService:
         Returns:
             Result dict with success status and message_id
         """
-        if not cls._initialized:
-            raise RuntimeError(
-                "Firebase is not initialized. Call FirebaseService.initialize() first."
-            )
+        tenant = cls.tenant()
 
         try:
             message = messaging.Message(
@@ -209,7 +605,8 @@ class FirebaseService:
                 token=token,
             )
 
-            response = messaging.send(message)
+            with phase("fcm-send"):
+                response = messaging.send(message, app=tenant.app)
             logger.info(f"Notification sent successfully: {response}")
             return {"success": True, "message_id": response}
 
@@ -266,6 +663,63 @@ class FirebaseService:
             auto_cleanup_invalid_tokens=auto_cleanup_invalid_tokens,
         )
 
+    @classmethod
+    async def send_to_user_async(
+        cls,
+        user_id: str,
+        title: str,
+        body: str,
+        data: dict[str, str] | None = None,
+        auto_cleanup_invalid_tokens: bool = True,
+        priority: NotificationPriority = NotificationPriority.NORMAL,
+        caller: str | None = None,
+    ) -> dict[str, Any]:
+        """
+        Send a push notification to all of a user's devices from async code.
+
+        Firestore reads and token cleanup use the asyncio client; the FCM call
+        itself is synchronous in the Admin SDK and is queued on the
+        notification dispatcher, which runs it in a worker thread.
+
+        Args:
+            user_id: The user's Firebase UID
+            title: Notification title
+            body: Notification body
+            data: Optional data payload
+            auto_cleanup_invalid_tokens: Whether to remove invalid tokens automatically
+            priority: Priority class used by the dispatcher
+            caller: Identity of the sender for fair queueing (defaults to user_id)
+
+        Returns:
+            Result dict with success_count, failure_count, and failed_tokens
+        """
+        tokens = await cls.get_user_device_tokens_async(user_id)
+
+        if not tokens:
+            logger.warning(f"No device tokens found for user: {user_id}")
+            return {
+                "success_count": 0,
+                "failure_count": 0,
+                "message": "No device tokens registered",
+            }
+
+        result = await get_dispatcher().submit(
+            priority,
+            f"{current_tenant.get()}:{caller or user_id}",
+            cls.send_multicast,
+            cost=min(len(tokens), 500),
+            tokens=tokens,
+            title=title,
+            body=body,
+            data=data,
+            auto_cleanup_invalid_tokens=False,
+        )
+
+        if auto_cleanup_invalid_tokens and not result.get("error"):
+            await cls.remove_device_tokens_async(user_id, result["failed_tokens"])
+
+        return result
+
     @classmethod
     def send_multicast(
         cls,
@@ -290,10 +744,7 @@ class FirebaseService:
         Returns:
             Result dict with success_count, failure_count, and failed_tokens
         """
-        if not cls._initialized:
-            raise RuntimeError(
-                "Firebase is not initialized. Call FirebaseService.initialize() first."
-            )
+        tenant = cls.tenant()
 
         if not tokens:
             return {"success_count": 0, "failure_count": 0, "failed_tokens": []}
@@ -310,7 +761,8 @@ class FirebaseService:
                 tokens=tokens,
             )
 
-            response = messaging.send_each_for_multicast(message)
+            with phase("fcm-multicast"):
+                response = messaging.send_each_for_multicast(message, app=tenant.app)
 
             success_count = response.success_count
             failure_count = response.failure_count
@@ -359,6 +811,12 @@ class FirebaseService:
             }
 
 
+def _device_tokens(user_doc: Any) -> list[str]:
+    """Extract the deviceTokens list from a user document snapshot."""
+    tokens = (user_doc.to_dict() or {}).get("deviceTokens", [])
+    return tokens if isinstance(tokens, list) else []
+
+
 @lru_cache
 def get_firebase_service() -> type[FirebaseService]:
     """Get the Firebase service singleton."""
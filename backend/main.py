@@ -9,6 +9,8 @@ from fastapi.middleware.cors import CORSMiddleware
 from auth import FirebaseUser, OptionalFirebaseUser
 from firebase_service import auto_initialize
 from notifications import router as notifications_router
+from sessions import router as sessions_router
+from timing import ServerTimingMiddleware
 
 # Load environment variables from .env file
 load_dotenv()
@@ -40,10 +42,15 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
+# Per-request phase timings (Server-Timing header) and slow-request profiles
+app.add_middleware(ServerTimingMiddleware)
+
 # Include routers
 app.include_router(notifications_router)
+app.include_router(sessions_router)
 
 
 # ============================================================================
@@ -10,13 +10,19 @@ from typing import Any
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel, Field
 
-from auth import FirebaseUser
+from auth import AdminUser, FirebaseUser, authorize
+from claims import get_permissions, get_roles
+from dispatcher import NotificationPriority, QueueFullError, get_dispatcher
 from firebase_service import get_firebase_service
+from timing import phase
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/notifications", tags=["notifications"])
 
+# Permission (custom claim) needed to send transactional notifications
+TRANSACTIONAL_PERMISSION = "notifications:transactional"
+
 
 class NotificationPayload(BaseModel):
     """Notification content to send."""
@@ -31,6 +37,14 @@ class NotificationPayload(BaseModel):
         default=None,
         description="Optional custom data payload (key-value pairs of strings)",
     )
+    priority: NotificationPriority = Field(
+        default=NotificationPriority.NORMAL,
+        description=(
+            "Priority class: transactional (e.g. password reset, security alert; "
+            "requires admin or the notifications:transactional permission), "
+            "normal, or bulk (campaigns)"
+        ),
+    )
 
 
 class SendNotificationResponse(BaseModel):
@@ -49,6 +63,48 @@ class SendToUserRequest(BaseModel):
     notification: NotificationPayload
 
 
+async def _authorize_priority(user: dict, priority: NotificationPriority) -> None:
+    """
+    Restrict the transactional class to admins and holders of the
+    notifications:transactional permission.
+
+    Raises:
+        HTTPException: 403 if the caller may not use the priority
+    """
+    if priority is not NotificationPriority.TRANSACTIONAL:
+        return
+
+    await authorize(
+        user,
+        lambda claims: (
+            "admin" in get_roles(claims)
+            or TRANSACTIONAL_PERMISSION in get_permissions(claims)
+        ),
+        detail="Not allowed to send transactional notifications",
+    )
+
+
+async def _send_to_user(**kwargs: Any) -> dict[str, Any]:
+    """
+    Send through FirebaseService.send_to_user_async.
+
+    Raises:
+        HTTPException: 503 if the dispatcher queue for the priority is full
+    """
+    firebase = get_firebase_service()
+
+    try:
+        with phase("send"):
+            return await firebase.send_to_user_async(**kwargs)
+    except QueueFullError as e:
+        logger.warning(f"Rejected notification: {e}")
+        raise HTTPException(
+            status_code=503,
+            detail="Notification queue is full, try again later",
+            headers={"Retry-After": "5"},
+        ) from e
+
+
 @router.post("/send", response_model=SendNotificationResponse)
 async def send_notification_to_self(
     payload: NotificationPayload,
@@ -64,13 +120,14 @@ async def send_notification_to_self(
     if not user_id:
         raise HTTPException(status_code=401, detail="User ID not found in token")
 
-    firebase = get_firebase_service()
+    await _authorize_priority(user, payload.priority)
 
-    result = firebase.send_to_user(
+    result = await _send_to_user(
         user_id=user_id,
         title=payload.title,
         body=payload.body,
         data=payload.data,
+        priority=payload.priority,
     )
 
     if result.get("error"):
@@ -91,22 +148,21 @@ async def send_notification_to_self(
 async def send_notification_to_user(
     user_id: str,
     payload: NotificationPayload,
-    _user: FirebaseUser,  # Require authentication
+    user: AdminUser,  # Require the "admin" role
 ) -> dict[str, Any]:
     """
     Send a notification to a specific user's devices.
 
     This endpoint can be used to send notifications to any user by their UID.
-    Requires authentication. In production, you may want to add additional
-    authorization checks (e.g., admin role).
+    Requires the "admin" role in the caller's custom claims.
     """
-    firebase = get_firebase_service()
-
-    result = firebase.send_to_user(
+    result = await _send_to_user(
         user_id=user_id,
         title=payload.title,
         body=payload.body,
         data=payload.data,
+        priority=payload.priority,
+        caller=user.get("uid"),
     )
 
     if result.get("error"):
@@ -139,7 +195,7 @@ async def test_notification(
     firebase = get_firebase_service()
 
     # Get token count for feedback
-    tokens = firebase.get_user_device_tokens(user_id)
+    tokens = await firebase.get_user_device_tokens_async(user_id)
 
     if not tokens:
         return {
@@ -148,7 +204,7 @@ async def test_notification(
             "token_count": 0,
         }
 
-    result = firebase.send_to_user(
+    result = await _send_to_user(
         user_id=user_id,
         title="Test Notification",
         body="If you see this, push notifications are working!",
@@ -162,3 +218,15 @@ async def test_notification(
         "success_count": result.get("success_count", 0),
         "failure_count": result.get("failure_count", 0),
     }
+
+
+@router.get("/dispatcher/stats")
+async def dispatcher_stats(
+    _user: AdminUser,  # Require the "admin" role
+) -> dict[str, Any]:
+    """
+    Per-priority-class queue depth, dispatch counts and queue-wait latency.
+
+    Latency percentiles cover the most recent dispatches of each class.
+    """
+    return get_dispatcher().stats()
@@ -0,0 +1,122 @@
+"""
+Sessions Router
+
+Exchanges short-lived Firebase ID tokens for long-lived session cookies.
+
+Browser clients can sign in once, call POST /session/login with their ID
+token, and from then on authenticate with the cookie instead of refreshing
+and sending an ID token on every request.
+"""
+
+import logging
+import os
+from datetime import timedelta
+from typing import Annotated, Any
+
+from fastapi import APIRouter, Cookie, Header, HTTPException, Response
+from starlette.concurrency import run_in_threadpool
+
+from auth import SESSION_COOKIE_NAME, parse_bearer_token
+from firebase_service import get_firebase_service
+from tenants import current_tenant, resolve_tenant
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/session", tags=["session"])
+
+
+def _session_lifetime() -> timedelta:
+    """Session lifetime from SESSION_COOKIE_DAYS (Firebase allows up to 14)."""
+    days = float(os.getenv("SESSION_COOKIE_DAYS", "5"))
+    return timedelta(days=min(max(days, 1), 14))
+
+
+def _secure_cookie() -> bool:
+    return os.getenv("SESSION_COOKIE_SECURE", "true").lower() != "false"
+
+
+@router.post("/login")
+async def create_session(
+    response: Response,
+    authorization: Annotated[str | None, Header()] = None,
+    x_tenant_id: Annotated[str | None, Header()] = None,
+) -> dict[str, Any]:
+    """
+    Exchange the Firebase ID token in the Authorization header for a session
+    cookie.
+
+    The ID token must come from a sign-in within the last five minutes.
+    """
+    if not authorization:
+        raise HTTPException(
+            status_code=401,
+            detail="Missing authentication token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    id_token = parse_bearer_token(authorization)
+
+    try:
+        current_tenant.set(resolve_tenant(x_tenant_id, id_token))
+    except LookupError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+
+    expires_in = _session_lifetime()
+
+    try:
+        firebase = get_firebase_service()
+        session_cookie = await run_in_threadpool(
+            firebase.create_session_cookie, id_token, expires_in
+        )
+
+    except RuntimeError as e:
+        logger.error(f"Firebase service error: {e}")
+        raise HTTPException(
+            status_code=503,
+            detail="Authentication service unavailable",
+        ) from e
+
+    except ValueError as e:
+        raise HTTPException(status_code=401, detail=str(e)) from e
+
+    response.set_cookie(
+        SESSION_COOKIE_NAME,
+        session_cookie,
+        max_age=int(expires_in.total_seconds()),
+        httponly=True,
+        secure=_secure_cookie(),
+        samesite="lax",
+    )
+
+    return {"success": True, "expires_in": int(expires_in.total_seconds())}
+
+
+@router.post("/logout")
+async def delete_session(
+    response: Response,
+    x_tenant_id: Annotated[str | None, Header()] = None,
+    session_cookie: Annotated[str | None, Cookie(alias=SESSION_COOKIE_NAME)] = None,
+) -> dict[str, Any]:
+    """
+    End the session and clear the session cookie.
+
+    The user's refresh tokens are revoked, so this cookie (and the user's
+    other sessions) stop being accepted: immediately on this instance, and on
+    other instances once their cached verification expires.
+    """
+    if session_cookie:
+        try:
+            current_tenant.set(resolve_tenant(x_tenant_id, session_cookie))
+            firebase = get_firebase_service()
+            await run_in_threadpool(firebase.revoke_session_cookie, session_cookie)
+        except (LookupError, RuntimeError, ValueError) as e:
+            logger.warning(f"Could not revoke session: {e}")
+
+    response.delete_cookie(
+        SESSION_COOKIE_NAME,
+        httponly=True,
+        secure=_secure_cookie(),
+        samesite="lax",
+    )
+
+    return {"success": True}
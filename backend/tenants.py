@@ -0,0 +1,317 @@
+"""
+Multi-tenant Firebase app registry.
+
+Lets a single backend process serve several Firebase projects. Each tenant
+gets its own initialized firebase_admin app together with its own token,
+device-token and custom-claims caches, so cached data never leaks across
+projects. Apps are created lazily on first use and deleted again after they
+have been idle for a while; the default tenant (the app created by
+FirebaseService.initialize) is never evicted.
+
+Tenants are configured with the FIREBASE_TENANTS environment variable, a JSON
+object mapping tenant IDs to service account credentials:
+
+    FIREBASE_TENANTS='{
+        "acme": {"credentials": "/secrets/acme-service-account.json"},
+        "globex": {"credentials": {"type": "service_account", ...}}
+    }'
+
+A request selects its tenant with the X-Tenant-ID header. Without the header,
+the tenant is chosen by matching the token's `aud` claim (the Firebase project
+ID) against the configured projects, falling back to the default tenant.
+"""
+
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import cached_property, lru_cache
+
+import firebase_admin
+from firebase_admin import credentials, firestore, firestore_async
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TENANT = "default"
+TENANT_HEADER = "X-Tenant-ID"
+
+# Tenant selected for the current request, set by the auth dependencies
+current_tenant: ContextVar[str] = ContextVar("current_tenant", default=DEFAULT_TENANT)
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+@dataclass
+class TenantApp:
+    """An initialized Firebase app and the caches scoped to it."""
+
+    tenant_id: str
+    app: firebase_admin.App
+    token_cache: TTLCache
+    device_cache: TTLCache
+    claims_cache: TTLCache
+    revocations: TTLCache
+    last_used: float = field(default_factory=time.monotonic)
+    _async_db_loop: asyncio.AbstractEventLoop | None = field(
+        default=None, init=False, repr=False
+    )
+
+    @cached_property
+    def db(self) -> firestore.Client:
+        """Shared synchronous Firestore client for this tenant."""
+        return firestore.client(self.app)
+
+    @cached_property
+    def async_db(self) -> firestore_async.AsyncClient:
+        """Shared asyncio Firestore client for this tenant."""
+        # The client's gRPC channel belongs to this loop and is closed on it
+        self._async_db_loop = asyncio.get_running_loop()
+        return firestore_async.client(self.app)
+
+    def close(self) -> None:
+        """Close the Firestore clients created for this tenant, if any."""
+        db = self.__dict__.get("db")
+        if db is not None:
+            db.close()
+            transport = getattr(db, "_transport", None)
+            if transport is not None:
+                transport.close()
+
+        async_db = self.__dict__.get("async_db")
+        transport = getattr(async_db, "_transport", None)
+        loop = self._async_db_loop
+        if transport is not None and loop is not None and not loop.is_closed():
+            asyncio.run_coroutine_threadsafe(transport.close(), loop)
+
+
+class FirebaseAppRegistry:
+    """Holds one Firebase app per tenant, created lazily and evicted when idle."""
+
+    def __init__(self) -> None:
+        self.idle_seconds = _env_float("FIREBASE_TENANT_IDLE_SECONDS", 900.0)
+        self.token_cache_ttl = _env_float("FIREBASE_TOKEN_CACHE_TTL", 300.0)
+        # Off by default: clients change deviceTokens directly in Firestore, so
+        # cached lists can be stale (removed devices still get pushes)
+        self.device_cache_ttl = _env_float("FIREBASE_DEVICE_CACHE_TTL", 0.0)
+        self.claims_cache_ttl = _env_float("FIREBASE_CLAIMS_CACHE_TTL", 300.0)
+        self._credentials: dict[str, credentials.Base] = {}
+        self._audiences: dict[str, str] = {}
+        self._apps: dict[str, TenantApp] = {}
+        self._configured = False
+        self._config_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def register_default(self, app: firebase_admin.App) -> None:
+        """Register the already-initialized default app."""
+        with self._lock:
+            self._apps[DEFAULT_TENANT] = self._new_tenant(DEFAULT_TENANT, app)
+
+    def register(
+        self,
+        tenant_id: str,
+        credential: credentials.Base,
+        project_id: str | None = None,
+    ) -> None:
+        """
+        Register a tenant. Its app is not initialized until first use.
+
+        Args:
+            tenant_id: Identifier used in the X-Tenant-ID header
+            credential: Credentials for the tenant's Firebase project
+            project_id: Firebase project ID (token `aud`); read from the
+                credential when omitted
+        """
+        if tenant_id == DEFAULT_TENANT:
+            raise ValueError(f"Tenant ID '{DEFAULT_TENANT}' is reserved")
+
+        project_id = project_id or getattr(credential, "project_id", None)
+        with self._lock:
+            self._credentials[tenant_id] = credential
+            if project_id:
+                self._audiences[project_id] = tenant_id
+
+    def configure_from_env(self) -> None:
+        """
+        Register tenants from the FIREBASE_TENANTS environment variable.
+
+        Runs once. Invalid entries are logged and skipped so that one bad
+        tenant cannot affect the default tenant or the other tenants.
+        """
+        if self._configured:
+            return
+
+        with self._config_lock:
+            if not self._configured:
+                self._load_tenants()
+                self._configured = True
+
+    def _load_tenants(self) -> None:
+        raw = os.getenv("FIREBASE_TENANTS")
+        if not raw:
+            return
+
+        try:
+            tenants = json.loads(raw)
+        except ValueError as e:
+            logger.error(f"Ignoring invalid FIREBASE_TENANTS: {e}")
+            return
+
+        if not isinstance(tenants, dict):
+            logger.error("Ignoring invalid FIREBASE_TENANTS: expected a JSON object")
+            return
+
+        for tenant_id, config in tenants.items():
+            try:
+                cred = credentials.Certificate(config["credentials"])
+                self.register(tenant_id, cred, config.get("project_id"))
+            except Exception as e:
+                logger.error(f"Skipping Firebase tenant {tenant_id}: {e}")
+                continue
+            logger.info(f"Registered Firebase tenant: {tenant_id}")
+
+    def is_known(self, tenant_id: str) -> bool:
+        """Whether the tenant is registered (initialized or not)."""
+        self.configure_from_env()
+        return tenant_id == DEFAULT_TENANT or tenant_id in self._credentials
+
+    def tenant_for_audience(self, audience: str) -> str | None:
+        """Map a token `aud` claim (Firebase project ID) to a tenant ID."""
+        self.configure_from_env()
+        return self._audiences.get(audience)
+
+    def get(self, tenant_id: str) -> TenantApp:
+        """
+        Get the app for a tenant, initializing it on first use.
+
+        Raises:
+            RuntimeError: If the tenant is unknown or its app is unavailable
+        """
+        self.configure_from_env()
+        self.evict_idle()
+
+        with self._lock:
+            tenant = self._apps.get(tenant_id)
+            if tenant is None:
+                tenant = self._initialize(tenant_id)
+            tenant.last_used = time.monotonic()
+            return tenant
+
+    def _initialize(self, tenant_id: str) -> TenantApp:
+        if tenant_id == DEFAULT_TENANT:
+            raise RuntimeError(
+                "Firebase is not initialized. Call FirebaseService.initialize() first."
+            )
+
+        cred = self._credentials.get(tenant_id)
+        if cred is None:
+            raise RuntimeError(f"Unknown Firebase tenant: {tenant_id}")
+
+        try:
+            app = firebase_admin.initialize_app(cred, name=f"tenant-{tenant_id}")
+        except Exception as e:
+            logger.error(f"Failed to initialize Firebase tenant {tenant_id}: {e}")
+            raise RuntimeError(f"Firebase initialization failed: {e}") from e
+
+        tenant = self._new_tenant(tenant_id, app)
+        self._apps[tenant_id] = tenant
+        logger.info(f"Initialized Firebase app for tenant: {tenant_id}")
+        return tenant
+
+    def _new_tenant(self, tenant_id: str, app: firebase_admin.App) -> TenantApp:
+        return TenantApp(
+            tenant_id=tenant_id,
+            app=app,
+            token_cache=TTLCache(maxsize=4096, ttl=self.token_cache_ttl),
+            device_cache=TTLCache(maxsize=4096, ttl=self.device_cache_ttl),
+            claims_cache=TTLCache(maxsize=4096, ttl=self.claims_cache_ttl),
+            # Per-user revocation time; kept as long as a cached token may live
+            revocations=TTLCache(maxsize=4096, ttl=self.token_cache_ttl),
+        )
+
+    def evict_idle(self) -> None:
+        """
+        Delete apps (and their caches) that have not been used recently.
+
+        The app is deleted while the lock is held, so a concurrent get() for
+        the same tenant cannot re-initialize it while its name is still taken.
+        """
+        cutoff = time.monotonic() - self.idle_seconds
+        with self._lock:
+            idle = [
+                tenant
+                for tenant_id, tenant in self._apps.items()
+                if tenant_id != DEFAULT_TENANT and tenant.last_used < cutoff
+            ]
+            for tenant in idle:
+                del self._apps[tenant.tenant_id]
+                firebase_admin.delete_app(tenant.app)
+
+        for tenant in idle:
+            try:
+                tenant.close()
+            except Exception as e:
+                logger.warning(
+                    f"Failed to close Firestore clients for tenant "
+                    f"{tenant.tenant_id}: {e}"
+                )
+            logger.info(f"Evicted idle Firebase app for tenant: {tenant.tenant_id}")
+
+
+def _unverified_audience(token: str) -> str | None:
+    """Read the `aud` claim from a JWT without verifying it."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+    except (IndexError, ValueError, binascii.Error):
+        return None
+    aud = claims.get("aud") if isinstance(claims, dict) else None
+    return aud if isinstance(aud, str) else None
+
+
+def resolve_tenant(tenant_header: str | None, token: str | None = None) -> str:
+    """
+    Pick the tenant for a request.
+
+    The token's `aud` is only used for routing here; the token is still fully
+    verified against the selected tenant's project afterwards, so a forged
+    `aud` just fails verification.
+
+    Raises:
+        LookupError: If the X-Tenant-ID header names an unknown tenant
+    """
+    registry = get_app_registry()
+
+    if tenant_header:
+        if not registry.is_known(tenant_header):
+            raise LookupError(f"Unknown tenant: {tenant_header}")
+        return tenant_header
+
+    if token:
+        aud = _unverified_audience(token)
+        if aud:
+            return registry.tenant_for_audience(aud) or DEFAULT_TENANT
+
+    return DEFAULT_TENANT
+
+
+@lru_cache
+def get_app_registry() -> FirebaseAppRegistry:
+    """
+    Get the process-wide app registry.
+
+    Tenant config is read on first use rather than here, so the default app
+    can be registered first.
+    """
+    return FirebaseAppRegistry()
@@ -0,0 +1,333 @@
+"""
+Request-scoped phase timing and slow-request profiling.
+
+Code on the request path records how long each phase took:
+
+    from timing import phase
+
+    with phase("verify-token"):
+        decoded_token = auth.verify_id_token(token)
+
+ServerTimingMiddleware collects the phases of each request and returns them
+in a Server-Timing response header (visible in browser dev tools), e.g.
+
+    Server-Timing: auth-parse;dur=0.02, verify-token;dur=41.3, total;dur=95.1
+
+Phases recorded in worker threads are included, since the request's timings
+travel with the context copied into those threads. Outside a request,
+phase() does nothing.
+
+Slow-request profiling is opt-in. With SLOW_REQUEST_PROFILE_DIR set, Python
+stacks are sampled while requests are running, and requests slower than
+SLOW_REQUEST_THRESHOLD_MS (default 1000) have their samples written to that
+directory in collapsed-stack format (one "frame;frame;frame count" line per
+stack), ready for flamegraph.pl, inferno or speedscope. Samples cover every
+busy thread in the process, so concurrent requests show up in each other's
+profiles. Threads idling in the event loop or a worker pool are skipped, so
+time a request spends awaiting I/O on the event loop leaves no samples.
+
+At most one profile is written per SLOW_REQUEST_PROFILE_COOLDOWN_SECONDS, and
+only the newest SLOW_REQUEST_PROFILE_MAX_FILES are kept, so an incident with
+many slow requests cannot fill the disk.
+
+Configuration (environment variables):
+    SERVER_TIMING: Set to "false" to disable the Server-Timing header
+    SLOW_REQUEST_PROFILE_DIR: Directory for slow-request profiles (unset = off)
+    SLOW_REQUEST_THRESHOLD_MS: Minimum duration to write a profile (default 1000)
+    SLOW_REQUEST_SAMPLE_INTERVAL_MS: Stack sampling interval (default 5)
+    SLOW_REQUEST_PROFILE_LINES: Set to "true" to add line numbers to frames
+        (splits a function into one flamegraph node per sampled line)
+    SLOW_REQUEST_PROFILE_COOLDOWN_SECONDS: Minimum time between profiles
+        (default 10)
+    SLOW_REQUEST_PROFILE_MAX_FILES: Profiles kept in the directory, oldest
+        deleted first (default 100, 0 = unlimited)
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+# Modules whose frames only wait (locks, queues, I/O selectors)
+_WAIT_MODULES = {"threading", "queue", "selectors"}
+
+# Loops that wait for work when their thread has nothing to do
+_IDLE_LOOPS = {
+    "asyncio.base_events:_run_once",
+    "concurrent.futures.thread:_worker",
+    "anyio._backends._asyncio:run",
+}
+
+
+class RequestTimings:
+    """Phase durations recorded for a single request."""
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.phases: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float) -> None:
+        """Add a duration to a phase; repeated phases are summed."""
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def header(self) -> str:
+        """Format the phases as a Server-Timing header value."""
+        with self._lock:
+            phases = list(self.phases.items())
+        phases.append(("total", time.perf_counter() - self.started))
+        return ", ".join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in phases)
+
+
+_request_timings: ContextVar[RequestTimings | None] = ContextVar(
+    "request_timings", default=None
+)
+
+
+def record_phase(name: str, seconds: float) -> None:
+    """Record a phase duration measured elsewhere (no-op outside a request)."""
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.record(name, seconds)
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Time the enclosed block as a named phase of the current request."""
+    timings = _request_timings.get()
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.record(name, time.perf_counter() - start)
+
+
+class StackSampler:
+    """
+    Background thread sampling busy Python stacks while requests are active.
+
+    Each active recording receives every sample taken during its lifetime.
+    The thread sleeps when no request is being recorded.
+    """
+
+    def __init__(self, interval: float, line_numbers: bool = False) -> None:
+        self.interval = interval
+        self.line_numbers = line_numbers
+        self._handles = itertools.count()
+        self._recordings: set[int] = set()
+        self._samples: dict[int, Counter[str]] = {}
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start_recording(self) -> int:
+        """Start collecting samples for a request and return its handle."""
+        with self._lock:
+            handle = next(self._handles)
+            self._recordings.add(handle)
+            self._samples[handle] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="slow-request-sampler", daemon=True
+                )
+                self._thread.start()
+        self._active.set()
+        return handle
+
+    def stop_recording(self, handle: int) -> Counter[str]:
+        """Stop collecting samples for a request and return them."""
+        with self._lock:
+            self._recordings.discard(handle)
+            if not self._recordings:
+                self._active.clear()
+            return self._samples.pop(handle, Counter())
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while True:
+            self._active.wait()
+            stacks = [
+                _collapse(frame, self.line_numbers)
+                for thread_id, frame in sys._current_frames().items()
+                if thread_id != own_id and not _is_idle(frame)
+            ]
+            with self._lock:
+                for handle in self._recordings:
+                    self._samples[handle].update(stacks)
+            time.sleep(self.interval)
+
+
+def _is_idle(frame: Any) -> bool:
+    """
+    Whether a thread is waiting for work rather than doing any.
+
+    Waits inside request code (e.g. on a lock or a future) are not idle; only
+    waits made directly by an event loop or worker pool loop are.
+    """
+    while frame is not None and frame.f_globals.get("__name__") in _WAIT_MODULES:
+        frame = frame.f_back
+    if frame is None:
+        return True
+    module = frame.f_globals.get("__name__")
+    return f"{module}:{frame.f_code.co_name}" in _IDLE_LOOPS
+
+
+def _collapse(frame: Any, line_numbers: bool = False) -> str:
+    """
+    Render a frame's stack, outermost first, as a collapsed-stack line.
+
+    Frames are identified as module:function (dotted module name, e.g.
+    firebase_admin.auth:verify_id_token) so that samples from different lines
+    of a function merge into one flamegraph node.
+    """
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        module = frame.f_globals.get("__name__") or "?"
+        name = f"{module}:{code.co_name}"
+        frames.append(f"{name}:{frame.f_lineno}" if line_numbers else name)
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+class SlowRequestProfiler:
+    """Writes sampled stacks of slow requests to a directory."""
+
+    def __init__(
+        self,
+        directory: str,
+        threshold: float,
+        interval: float,
+        line_numbers: bool = False,
+        cooldown: float = 10.0,
+        max_files: int = 100,
+    ) -> None:
+        self.directory = Path(directory)
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_files = max_files
+        self.sampler = StackSampler(interval, line_numbers)
+        self._last_written = float("-inf")
+
+    def claim(self) -> bool:
+        """Reserve the next profile write, unless one was written too recently."""
+        now = time.monotonic()
+        if now - self._last_written < self.cooldown:
+            return False
+        self._last_written = now
+        return True
+
+    def write(self, scope: dict, seconds: float, samples: Counter[str]) -> Path:
+        """Write a request's samples in collapsed-stack format."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        timestamp = datetime.now(UTC).strftime("%Y%m%dT%H%M%S%f")
+        path_slug = re.sub(r"[^A-Za-z0-9]+", "_", scope.get("path", "")).strip("_")
+        filename = (
+            f"{timestamp}-{scope.get('method', 'GET')}-{path_slug or 'root'}"
+            f"-{int(seconds * 1000)}ms.folded"
+        )
+
+        output = self.directory / filename
+        with output.open("w") as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+        self._remove_old_profiles()
+        return output
+
+    def _remove_old_profiles(self) -> None:
+        if self.max_files <= 0:
+            return
+        # File names start with a UTC timestamp, so they sort oldest first
+        profiles = sorted(self.directory.glob("*.folded"))
+        for old in profiles[: -self.max_files]:
+            old.unlink(missing_ok=True)
+
+
+class ServerTimingMiddleware:
+    """ASGI middleware adding Server-Timing headers and slow-request profiles."""
+
+    def __init__(self, app: Any) -> None:
+        self.app = app
+        self.enabled = os.getenv("SERVER_TIMING", "true").lower() != "false"
+
+        self.profiler: SlowRequestProfiler | None = None
+        profile_dir = os.getenv("SLOW_REQUEST_PROFILE_DIR")
+        if profile_dir:
+            threshold_ms = float(os.getenv("SLOW_REQUEST_THRESHOLD_MS", "1000"))
+            interval_ms = float(os.getenv("SLOW_REQUEST_SAMPLE_INTERVAL_MS", "5"))
+            line_numbers = os.getenv("SLOW_REQUEST_PROFILE_LINES", "").lower()
+            self.profiler = SlowRequestProfiler(
+                profile_dir,
+                threshold=threshold_ms / 1000,
+                interval=interval_ms / 1000,
+                line_numbers=line_numbers == "true",
+                cooldown=float(
+                    os.getenv("SLOW_REQUEST_PROFILE_COOLDOWN_SECONDS", "10")
+                ),
+                max_files=int(os.getenv("SLOW_REQUEST_PROFILE_MAX_FILES", "100")),
+            )
+            logger.info(f"Slow-request profiling enabled, writing to {profile_dir}")
+
+    async def __call__(self, scope: dict, receive: Any, send: Any) -> None:
+        if scope["type"] != "http" or not (self.enabled or self.profiler):
+            await self.app(scope, receive, send)
+            return
+
+        timings = RequestTimings()
+        token = _request_timings.set(timings)
+        handle = self.profiler.sampler.start_recording() if self.profiler else None
+
+        async def send_with_timing(message: dict) -> None:
+            if message["type"] == "http.response.start" and self.enabled:
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timings.header().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
+            if handle is not None:
+                await self._finish_profile(scope, timings, handle)
+
+    async def _finish_profile(
+        self, scope: dict, timings: RequestTimings, handle: int
+    ) -> None:
+        samples = self.profiler.sampler.stop_recording(handle)
+        seconds = time.perf_counter() - timings.started
+        if seconds < self.profiler.threshold or not samples:
+            return
+        if not self.profiler.claim():
+            return
+
+        try:
+            output = await asyncio.to_thread(
+                self.profiler.write, scope, seconds, samples
+            )
+            logger.warning(
+                f"Slow request {scope.get('method')} {scope.get('path')} took "
+                f"{seconds * 1000:.0f}ms, profile written to {output}"
+            )
+        except OSError as e:
+            logger.error(f"Failed to write slow-request profile: {e}")